@@ -34,7 +34,8 @@ import pyworkflow.utils as pwutils
 from pyworkflow import Config
 
 from .constants import (EMAN2SCRATCHDIR, VERSIONS, EMAN_ENV_ACTIVATION,
-                        DEFAULT_ACTIVATION_CMD, EMAN_DEFAULT_VER_NUM)
+                        DEFAULT_ACTIVATION_CMD, EMAN_DEFAULT_VER_NUM,
+                        DEFAULT_SCRATCHDIR)
 
 
 __version__ = '3.6.1'
@@ -49,7 +50,7 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineVar(EMAN_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
-        cls._defineVar(EMAN2SCRATCHDIR, '/tmp')
+        cls._defineVar(EMAN2SCRATCHDIR, DEFAULT_SCRATCHDIR)
 
     @classmethod
     def getEnviron(cls):
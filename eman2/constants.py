@@ -25,6 +25,10 @@
 # **************************************************************************
 
 EMAN2SCRATCHDIR = 'EMAN2SCRATCHDIR'
+DEFAULT_SCRATCHDIR = '/tmp'
+# RAM disk used instead of the default scratch when it has enough room
+SHM_SCRATCHDIR = '/dev/shm'
+SHM_MIN_FREE = 4 * 1024 ** 3  # bytes
 
 # Supported versions
 VERSIONS = ['2.99.47', '2.99.52', '2.99.55']
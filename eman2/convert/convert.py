@@ -32,6 +32,7 @@ import glob
 import json
 import numpy
 import os
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
@@ -128,10 +129,23 @@ def readSetOfCoordinates(workDir, micSet, coordSet, invertY=False):
     jsonBoxDict = loadJson(jsonFnbase)
     size = int(jsonBoxDict["global.boxsize"])
     jsonFninfo = os.path.join(workDir, 'info/')
+    # list the info folder once, index the files by micrograph base name
+    infoFiles = []
+    if os.path.isdir(jsonFninfo):
+        with os.scandir(jsonFninfo) as it:
+            infoFiles = sorted(jsonFninfo + entry.name for entry in it
+                               if entry.name.endswith('_info.json') and
+                               entry.is_file())
+    infoDict = {os.path.basename(fn)[:-len('_info.json')]: fn
+                for fn in infoFiles}
 
     for mic in micSet:
         micBase = pwutils.removeBaseExt(mic.getFileName())
-        micPosFn = ''.join(glob.glob(jsonFninfo + '*' + micBase + '_info.json'))
+        micPosFn = infoDict.get(micBase)
+        if micPosFn is None:
+            # info files may have a prefix before the micrograph name
+            micPosFn = ''.join(fn for fn in infoFiles
+                               if fn.endswith(micBase + '_info.json'))
         readCoordinates(mic, micPosFn, coordSet, invertY)
     coordSet.setBoxSize(size)
 
@@ -148,16 +162,19 @@ def readCoordinates(mic, fileName, coordsSet, invertY=False):
 
         if "boxes" in jsonPosDict:
             boxes = jsonPosDict["boxes"]
+            yDim = mic.getYDim() if invertY else None
+            # the same object is reused, the set stores a copy of its values
+            coord = Coordinate()
+            coord.setMicrograph(mic)
 
             for box in boxes:
                 x, y = box[:2]
 
                 if invertY:
-                    y = mic.getYDim() - y
+                    y = yDim - y
 
-                coord = Coordinate()
+                coord.setObjId(None)
                 coord.setPosition(x, y)
-                coord.setMicrograph(mic)
                 coordsSet.append(coord)
 
 
@@ -185,15 +202,22 @@ def writeSetOfMicrographs(micSet, filename):
 
 
 def readSetOfParticles(lstFile, partSet, copyOrLink, direc):
+    # stack paths in the lst file are relative to the project folder
+    abspath = os.path.abspath(lstFile)
+    projDir = abspath.replace('sets/%s' % os.path.basename(lstFile), '')
+    # many particles share a stack, copy or link each one once
+    newFns = {}
     for index, fn in iterLstFile(lstFile):
-        item = Particle()
-        # set full path to particles stack file
-        abspath = os.path.abspath(lstFile)
-        fn = abspath.replace('sets/%s' % os.path.basename(lstFile), '') + fn
-        newFn = os.path.join(direc, os.path.basename(fn))
-        if not os.path.exists(newFn):
-            copyOrLink(fn, newFn)
+        newFn = newFns.get(fn)
+        if newFn is None:
+            # set full path to particles stack file
+            stackFn = projDir + fn
+            newFn = os.path.join(direc, os.path.basename(stackFn))
+            if not os.path.exists(newFn):
+                copyOrLink(stackFn, newFn)
+            newFns[fn] = newFn
 
+        item = Particle()
         item.setLocation(index, newFn)
         partSet.append(item)
 
@@ -202,6 +226,8 @@ def writeSetOfParticles(partSet, path, **kwargs):
     """ Convert the imgSet particles to .hdf files as expected by Eman.
     This function should be called from a current dir where
     the images in the set are available.
+    Accepted kwargs are alignType, suffix and threads, the
+    number of EMAN processes used to write the stacks.
     """
     ext = pwutils.getExt(partSet.getFirstItem().getFileName())[1:]
     if ext == 'hdf':
@@ -217,49 +243,52 @@ def writeSetOfParticles(partSet, path, **kwargs):
         if firstCoord:
             hasMicName = firstCoord.getMicName() or False
 
-        fileName = ""
-        a = 0
-        proc = Plugin.createEmanProcess(args='write')
-
-        for i, part in iterParticlesByMic(partSet):
-            micName = micId = part.getMicId()
-            if hasMicName:
-                micName = pwutils.removeBaseExt(part.getCoordinate().getMicName())
-            objDict = part.getObjDict()
-
-            if not micId:
-                micId = 0
-
-            suffix = kwargs.get('suffix', '')
-            if hasMicName and (micName != str(micId)):
-                objDict['hdfFn'] = os.path.join(path,
-                                                "%s%s.hdf" % (micName, suffix))
-            else:
-                objDict['hdfFn'] = os.path.join(path,
-                                                "mic_%06d%s.hdf" % (micId, suffix))
-
-            alignType = kwargs.get('alignType')
-
-            if alignType != emcts.ALIGN_NONE:
-                shift, angles = alignmentToRow(part.getTransform(), alignType)
-                # json cannot encode arrays so I convert them to lists
-                # json fail if has -0 as value
-                objDict['_shifts'] = shift.tolist()
-                objDict['_angles'] = angles.tolist()
-            objDict['_itemId'] = part.getObjId()
-
-            # the index in EMAN begins with 0
-            if fileName != objDict['_filename']:
-                fileName = objDict['_filename']
-                if objDict['_index'] == 0:  # TODO: Index appears to be the problem (when not given it works ok)
-                    a = 0
-                else:
-                    a = 1
-            objDict['_index'] = int(objDict['_index'] - a)
-            # Write the e2converter.py process from where to read the image
-            print(json.dumps(objDict), file=proc.stdin, flush=True)
-            proc.stdout.readline()
-        proc.kill()
+        suffix = kwargs.get('suffix', '')
+        alignType = kwargs.get('alignType')
+
+        def iterObjDicts():
+            fileName = ""
+            a = 0
+            # particles come sorted by micrograph, so the output
+            # file name only changes when the micrograph does
+            lastMic = None
+            hdfFn = None
+            for i, part in iterParticlesByMic(partSet):
+                micId = part.getMicId()
+                micName = part.getCoordinate().getMicName() if hasMicName else None
+                objDict = part.getObjDict()
+
+                if (micName, micId) != lastMic:
+                    lastMic = (micName, micId)
+                    micId = micId or 0
+                    if hasMicName:
+                        micName = pwutils.removeBaseExt(micName)
+                    if hasMicName and (micName != str(micId)):
+                        hdfFn = os.path.join(path, "%s%s.hdf" % (micName, suffix))
+                    else:
+                        hdfFn = os.path.join(path, "mic_%06d%s.hdf" % (micId, suffix))
+                objDict['hdfFn'] = hdfFn
+
+                if alignType != emcts.ALIGN_NONE:
+                    shift, angles = alignmentToRow(part.getTransform(), alignType)
+                    # json cannot encode arrays so I convert them to lists
+                    # json fail if has -0 as value
+                    objDict['_shifts'] = shift.tolist()
+                    objDict['_angles'] = angles.tolist()
+                objDict['_itemId'] = part.getObjId()
+
+                # the index in EMAN begins with 0
+                if fileName != objDict['_filename']:
+                    fileName = objDict['_filename']
+                    if objDict['_index'] == 0:  # TODO: Index appears to be the problem (when not given it works ok)
+                        a = 0
+                    else:
+                        a = 1
+                objDict['_index'] = int(objDict['_index'] - a)
+                yield objDict
+
+        # particles of different micrographs are written in parallel
+        _writeWithEman(iterObjDicts(), kwargs.get('threads', 1))
 
 
 def getImageDimensions(imageFile):
@@ -302,6 +331,31 @@ def iterLstFile(filename):
                 yield index, filename
 
 
+def loadResultsFile(filename, numCols, firstCol=0):
+    """ Load the results text file written by e2converter.py
+    into a 2D numpy array with one row per particle.
+    :param filename: input text file
+    :param numCols: number of columns of the enabled rows,
+        shorter rows of disabled particles are padded with zeros
+    :param firstCol: first column to load, the ones before
+        it (e.g. the particle index) are not parsed
+    :return: numpy array of shape (n, numCols - firstCol)
+    """
+    try:
+        return numpy.loadtxt(filename, comments='#', ndmin=2,
+                             usecols=range(firstCol, numCols))
+    except (ValueError, IndexError):
+        # files written by older versions have shorter disabled rows,
+        # numpy < 1.23 reports the missing columns as an IndexError
+        rows = []
+        with open(filename) as f:
+            for line in f:
+                if '#' not in line and line.strip():
+                    row = [float(x) for x in line.split()]
+                    rows.append(row + [0.0] * (numCols - len(row)))
+        return numpy.array(rows).reshape(-1, numCols)[:, firstCol:]
+
+
 def geometryFromMatrix(matrix, inverseTransform):
     """ Convert the transformation matrix to shifts and angles.
     :param matrix: input matrix
@@ -382,6 +436,50 @@ def rowToAlignment(alignmentList, alignType):
     return alignment
 
 
+def rowsToMatrices(alignmentRows, alignType):
+    """ Vectorized version of rowToAlignment that builds the
+    transformation matrices of all rows at once.
+    :param alignmentRows: 2D array with rot, tilt, psi, shiftX, shiftY columns
+    :param alignType: alignment type, ALIGN_PROJ means inverse transform
+    :return: array of shape (n, 4, 4)
+    """
+    rows = numpy.asarray(alignmentRows, dtype=float).reshape(-1, 5)
+    # same as euler_matrix(-rot, -tilt, -psi, 'szyz') in matrixFromGeometry,
+    # the parity of szyz negates the angles back
+    ai, aj, ak = numpy.deg2rad(rows[:, :3]).T
+    si, sj, sk = numpy.sin(ai), numpy.sin(aj), numpy.sin(ak)
+    ci, cj, ck = numpy.cos(ai), numpy.cos(aj), numpy.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    rot = numpy.empty((len(rows), 3, 3))
+    rot[:, 2, 2] = cj
+    rot[:, 2, 1] = sj * si
+    rot[:, 2, 0] = sj * ci
+    rot[:, 1, 2] = sj * sk
+    rot[:, 1, 1] = -cj * ss + cc
+    rot[:, 1, 0] = -cj * cs - sc
+    rot[:, 0, 2] = -sj * ck
+    rot[:, 0, 1] = cj * sc + cs
+    rot[:, 0, 0] = cj * cc - ss
+
+    shifts = numpy.zeros((len(rows), 3))
+    shifts[:, :2] = rows[:, 3:5]
+
+    matrices = numpy.zeros((len(rows), 4, 4))
+    matrices[:, 3, 3] = 1.0
+    if alignType == emcts.ALIGN_PROJ:
+        # the rotation is orthonormal, so the inverse of [R | -t] is [R' | R't]
+        rotT = rot.transpose(0, 2, 1)
+        matrices[:, :3, :3] = rotT
+        matrices[:, :3, 3] = numpy.einsum('nij,nj->ni', rotT, shifts)
+    else:
+        matrices[:, :3, :3] = rot
+        matrices[:, :3, 3] = shifts
+
+    return matrices
+
+
 def iterParticlesByMic(partSet):
     """ Iterate the particles ordered by micrograph """
     for i, part in enumerate(partSet.iterItems(orderBy=['_micId', 'id'],
@@ -389,32 +487,91 @@ def iterParticlesByMic(partSet):
         yield i, part
 
 
+def iterRepresentatives(classesSet):
+    """ Iterate over the representatives of a set of classes without
+    creating an intermediate set of particles.
+    The representatives get the sampling rate of the classified images.
+    """
+    pixSize = classesSet.getImages().getSamplingRate()
+    for i, cls in enumerate(classesSet):
+        img = cls.getRepresentative()
+        img.setSamplingRate(pixSize)
+        img.setObjId(i + 1)
+        yield img
+
+
 def convertReferences(refSet, outputFn):
     """ Simplified version of writeSetOfParticles function.
     Writes out an hdf stack.
     """
-    fileName = ""
-    a = 0
-    proc = Plugin.createEmanProcess(args='write')
-
-    for part in refSet:
-        objDict = part.getObjDict()
-        objDict['hdfFn'] = outputFn
-        objDict['_itemId'] = part.getObjId()
-
-        # the index in EMAN begins with 0
-        if fileName != objDict['_filename']:
-            fileName = objDict['_filename']
-            if objDict['_index'] == 0:
-                a = 0
-            else:
-                a = 1
-        objDict['_index'] = int(objDict['_index'] - a)
-
-        # Write the e2converter.py process from where to read the image
-        print(json.dumps(objDict), file=proc.stdin, flush=True)
-        proc.stdout.readline()
-    proc.kill()
+    def iterObjDicts():
+        fileName = ""
+        a = 0
+        for part in refSet:
+            objDict = part.getObjDict()
+            objDict['hdfFn'] = outputFn
+            objDict['_itemId'] = part.getObjId()
+
+            # the index in EMAN begins with 0
+            if fileName != objDict['_filename']:
+                fileName = objDict['_filename']
+                if objDict['_index'] == 0:
+                    a = 0
+                else:
+                    a = 1
+            objDict['_index'] = int(objDict['_index'] - a)
+            yield objDict
+
+    _writeWithEman(iterObjDicts())
+
+
+def _writeWithEman(objDicts, numProcs=1):
+    """ Stream the images to e2converter.py processes in write mode.
+    The images are sent without waiting for each one to be written,
+    so reading the input overlaps with the EMAN conversion.
+    All the images of an output stack go to the same process, which
+    numbers them in the order they are received, so the images of a
+    stack keep their order even if they are not contiguous in objDicts.
+    :param objDicts: iterable of image dicts with the output 'hdfFn'
+    :param numProcs: number of e2converter.py processes to use
+    """
+    procs = [Plugin.createEmanProcess(args='write')
+             for _ in range(max(1, numProcs))]
+    # Drain the OK lines so e2converter.py never blocks on a full pipe
+    readers = [threading.Thread(target=proc.stdout.read, daemon=True)
+               for proc in procs]
+    for reader in readers:
+        reader.start()
+
+    procByFn = {}
+    try:
+        for objDict in objDicts:
+            hdfFn = objDict['hdfFn']
+            proc = procByFn.get(hdfFn)
+            if proc is None:
+                proc = procs[len(procByFn) % len(procs)]
+                procByFn[hdfFn] = proc
+            # Write the e2converter.py process from where to read the image
+            proc.stdin.write(json.dumps(objDict) + '\n')
+    except BrokenPipeError:
+        pass  # a process died, it is reported below from its return code
+    finally:
+        # also when objDicts fails, so the processes see the end
+        # of their input and exit instead of waiting for more images
+        for proc in procs:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for reader in readers:
+            reader.join()
+        for proc in procs:
+            proc.wait()
+
+    failed = [proc.returncode for proc in procs if proc.returncode != 0]
+    if failed:
+        raise RuntimeError("e2converter.py failed writing the images, "
+                           "exit codes: %s" % failed)
 
 
 def calculatePhaseShift(ampcont):
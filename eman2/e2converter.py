@@ -45,7 +45,7 @@ MODE_READ = 'read'
 
 def writeParticles():
     line = sys.stdin.readline()
-    fnHdf = ""
+    indexes = {}
     while line:
         objDict = json.loads(line)
         index = int(objDict['_index'])
@@ -88,14 +88,14 @@ def writeParticles():
         if transformation is not None:
             imageData.set_attr('xform.projection', transformation)
 
+        # images of a stack may come interleaved with other stacks,
+        # so keep the next index of each output file
         outputFile = str(objDict['hdfFn'])
-        if outputFile != fnHdf:
-            i = 0
-            fnHdf = outputFile
+        i = indexes.get(outputFile, 0)
 
         imageData.write_image(outputFile, i,
                               eman.EMUtil.ImageType.IMAGE_HDF, False)
-        i += 1
+        indexes[outputFile] = i + 1
         print("OK")  # it is necessary to add newline
         sys.stdout.flush()
         line = sys.stdin.readline()
@@ -103,30 +103,24 @@ def writeParticles():
 
 def readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype='3d'):
     imgs = eman.EMUtil.get_image_count(inputParts)
-    clsClassDict = {}
-    shiftXList = {}
-    shiftYList = {}
-    dAlphaList = {}
-    flipList = {}
     with open(outputTxt, 'w') as f:
 
         if alitype == '2d':
             # reading 2d refinement results
             clsImgs = eman.EMData.read_images(inputCls)
             classes = eman.EMData.read_images(inputClasses)
-            clsClassList = clsImgs[0]
             f.write('#index, enable, cls, rot, tilt, psi, shiftX, shiftY\n')
 
-            for i in range(clsClassList.get_attr_dict()['ny']):
-                clsClassDict[i] = clsClassList[0, i]
-                shiftXList[i] = clsImgs[2][0, i]
-                shiftYList[i] = clsImgs[3][0, i]
-                dAlphaList[i] = clsImgs[4][0, i]
-                flipList[i] = clsImgs[5][0, i]
+            # read the first column of each classmx image as a whole
+            # instead of accessing the values one by one, the numpy
+            # array is (ny, nx) so [:, 0] is the old [0, i] access
+            (clsClassList, _, shiftXList, shiftYList,
+             dAlphaList, flipList) = [eman.EMNumPy.em2numpy(img)[:, 0].tolist()
+                                      for img in clsImgs[:6]]
 
             # now convert eman orientation to scipion
             for index in range(imgs):
-                classNum = clsClassDict[index]
+                classNum = clsClassList[index]
                 imgRotation = classes[int(classNum)].get_attr_dict().get('xform.projection', None)
 
                 if imgRotation is not None:
@@ -150,8 +144,8 @@ def readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype='3d'):
 
                     f.write(('{} '*8 + '\n').format(index, enable, int(classNum), rot, tilt, psi, shiftX, shiftY))
                 else:
-                    # disabled image
-                    f.write(('{} '*2 + '\n').format(index, 0))
+                    # disabled image, padded so all rows have the same columns
+                    f.write(('{} '*8 + '\n').format(index, 0, 0, 0, 0, 0, 0, 0))
 
         else:
             # reading 3d refinement results
@@ -164,6 +158,12 @@ def readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype='3d'):
             clsClassListOdd = clsImgsOdd[0]
             f.write('#index, enable, rot, tilt, psi, shiftX, shiftY\n')
 
+            clsClassDict = {}
+            shiftXList = {}
+            shiftYList = {}
+            dAlphaList = {}
+            flipList = {}
+
             for i in range(clsClassListEven.get_attr_dict()['ny']):
                 clsClassDict[2 * i] = clsClassListEven[0, i]
                 shiftXList[2 * i] = clsImgsEven[2][0, i]
@@ -216,8 +216,8 @@ def readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype='3d'):
 
                     f.write(('{} '*7 + '\n').format(index, enable, rot, tilt, psi, shiftX, shiftY))
                 else:
-                    # disabled image
-                    f.write(('{} '*2 + '\n').format(index, 0))
+                    # disabled image, padded so all rows have the same columns
+                    f.write(('{} '*7 + '\n').format(index, 0, 0, 0, 0, 0, 0))
 
 
 if __name__ == '__main__':
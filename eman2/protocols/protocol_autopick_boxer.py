@@ -60,6 +60,7 @@ class EmanProtAutopick(ProtParticlePickingAuto):
 
     def __init__(self, **kwargs):
         ProtParticlePickingAuto.__init__(self, **kwargs)
+        self._pickParams = None
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -183,34 +184,44 @@ class EmanProtAutopick(ProtParticlePickingAuto):
 
     def _pickMicrograph(self, mic, *args):
         micFile = os.path.relpath(mic.getFileName(), self.getCoordsDir())
-        params = " --apix=%f --no_ctf" % self.inputMicrographs.get().getSamplingRate()
-        params += " --boxsize=%d" % self.boxSize.get()
-        params += " --ptclsize=%d" % self.particleSize.get()
-        params += " --threads=%d" % self.numberOfThreads.get()
-
-        modes = ['auto_local', 'auto_ref', 'auto_convnet', 'auto_gauss']
-        params += " --autopick=%s" % modes[self.boxerMode.get()]
-
-        if self.boxerMode.get() == AUTO_GAUSS:
-            params += ":gauss_width=%0.3f:thr_low=%0.3f:thr_high=%0.3f:boxsize=%d" % (
-                self.gaussWidth.get(), self.gaussLow.get(),
-                self.gaussHigh.get(), self.boxSize.get())
-        else:
-            params += ":threshold=%0.2f" % self.threshold.get()
-
-        if self.boxerMode.get() == AUTO_CONVNET:
-            params += ":threshold2=%0.2f" % self.threshold2.get()
-
-            if self.useGpu:
-                params += " --device=gpu%s" % self.gpuList.get().strip()
-            else:
-                params += " --device=cpu"
-
-        params += ' %s' % micFile
+        params = self._getPickParams() + ' %s' % micFile
         program = Plugin.getProgram('e2boxer.py')
 
         self.runJob(program, params, cwd=self.getCoordsDir())
 
+    def _getPickParams(self):
+        """ Return the e2boxer.py options shared by all micrographs,
+        they are only built for the first one. """
+        if self._pickParams is None:
+            boxSize = self.boxSize.get()
+            boxerMode = self.boxerMode.get()
+            params = " --apix=%f --no_ctf" % self.inputMicrographs.get().getSamplingRate()
+            params += " --boxsize=%d" % boxSize
+            params += " --ptclsize=%d" % self.particleSize.get()
+            params += " --threads=%d" % self.numberOfThreads.get()
+
+            modes = ['auto_local', 'auto_ref', 'auto_convnet', 'auto_gauss']
+            params += " --autopick=%s" % modes[boxerMode]
+
+            if boxerMode == AUTO_GAUSS:
+                params += ":gauss_width=%0.3f:thr_low=%0.3f:thr_high=%0.3f:boxsize=%d" % (
+                    self.gaussWidth.get(), self.gaussLow.get(),
+                    self.gaussHigh.get(), boxSize)
+            else:
+                params += ":threshold=%0.2f" % self.threshold.get()
+
+            if boxerMode == AUTO_CONVNET:
+                params += ":threshold2=%0.2f" % self.threshold2.get()
+
+                if self.useGpu:
+                    params += " --device=gpu%s" % self.gpuList.get().strip()
+                else:
+                    params += " --device=cpu"
+
+            self._pickParams = params
+
+        return self._pickParams
+
     def createOutputStep(self):
         pass
 
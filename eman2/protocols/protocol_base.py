@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# *  Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+# e2converter.py processes run at once when the viewer converts
+# several iterations, the protocol threads are meant for the cluster
+MAX_CONVERT_PROCS = 4
+
+
+def scanIterations(runDir, regex):
+    """ List the run folder once and return the sorted iteration
+    numbers of the files whose whole name matches regex, its first
+    group being the iteration number. """
+    iters = []
+    if os.path.isdir(runDir):
+        with os.scandir(runDir) as it:
+            for entry in it:
+                match = regex.fullmatch(entry.name)
+                if match:
+                    iters.append(int(match.group(1)))
+
+    return sorted(iters)
+
+
+class EmanFileNamesMixin:
+    """ Cache the file names returned by _getFileName, the viewers
+    format the same templates many times with the same arguments.
+    It must come before the Protocol class in the bases list.
+    """
+
+    def _updateFilenamesDict(self, fnDict):
+        """ Forget the cached names when the templates change. """
+        self._cachedFileNames = {}
+        super()._updateFilenamesDict(fnDict)
+
+    def _getFileName(self, key, **kwargs):
+        cache = self.__dict__.setdefault('_cachedFileNames', {})
+        cacheKey = (key, tuple(sorted(kwargs.items())))
+        if cacheKey not in cache:
+            cache[cacheKey] = super()._getFileName(key, **kwargs)
+
+        return cache[cacheKey]
+
+
+class EmanIterClassesMixin:
+    """ Convert the classes of several iterations of a 2D refinement.
+    The protocol provides _getIterClasses(it, convert) and
+    _startEmanProcess(it), that launches e2converter.py for one
+    iteration without waiting for it.
+    """
+
+    def _getIterClassesList(self, iterations, maxProcs=None):
+        """ Return the classes .sqlite files for several iterations.
+        The EMAN results of the missing iterations are converted in
+        parallel, up to maxProcs processes, then the sqlite files
+        are written one by one.
+        """
+        pending = [it for it in iterations if not os.path.exists(
+            self._getFileName('classes_scipion', iter=it))]
+        if maxProcs is None:
+            maxProcs = min(MAX_CONVERT_PROCS, os.cpu_count() or 1)
+
+        for i in range(0, len(pending), maxProcs):
+            self._waitEmanProcesses([self._startEmanProcess(it)
+                                     for it in pending[i:i + maxProcs]])
+
+        return [self._getIterClasses(it, convert=it not in pending)
+                for it in iterations]
+
+    def _waitEmanProcesses(self, procs):
+        """ Wait for all the processes and raise if any of them failed. """
+        for proc in procs:
+            proc.communicate()
+        failed = [proc.returncode for proc in procs if proc.returncode != 0]
+        if failed:
+            raise RuntimeError("e2converter.py failed reading the classes, "
+                               "exit codes: %s" % failed)
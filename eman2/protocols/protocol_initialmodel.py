@@ -25,10 +25,11 @@
 # **************************************************************************
 
 import os
-from glob import glob
+import re
+import shutil
 from enum import Enum
 
-from pyworkflow.utils.path import cleanPattern
+from pyworkflow.utils.path import cleanPath
 from pyworkflow.constants import PROD
 from pyworkflow.protocol.params import (PointerParam, IntParam,
                                         BooleanParam, LEVEL_ADVANCED,
@@ -37,7 +38,11 @@ from pwem.protocols import ProtInitialVolume
 from pwem.objects.data import SetOfClasses2D, Volume, SetOfVolumes
 
 from .. import Plugin
-from ..constants import EMAN2SCRATCHDIR
+from ..convert import convertReferences, iterRepresentatives
+from ..constants import EMAN2SCRATCHDIR, SHM_SCRATCHDIR, SHM_MIN_FREE
+
+# symmetries reconstructed with e2initialmodel_hisym.py
+_HIGH_SYM = frozenset({'oct', 'tet', 'icos'})
 
 
 class outputs(Enum):
@@ -125,52 +130,45 @@ class EmanProtInitModel(ProtInitialVolume):
         self._insertFunctionStep('createOutputStep')
 
     def _insertInitialModelStep(self):
-        args = '--input=%(relImgsFn)s --sym=%(symmetry)s'
-        if self.shrink > 1:
-            args += ' --shrink=%(shrink)d'
-        if not self._isHighSym():
-            args += ' --tries=%(numberOfModels)d --iter=%(numberOfIterations)d'
-            if self.randOrient:
-                args += ' --randorient'
-            if self.autoMaskExp.get() != -1:
-                args += '--automaskexpand %d'
-            if self.numberOfMpi > 1:
-                args += ' --parallel=mpi:%(mpis)d:%(scratch)s'
+        p = self._params
+        args = ['--input=%(relImgsFn)s', '--sym=%(symmetry)s']
+        if p['shrink'] > 1:
+            args.append('--shrink=%(shrink)d')
+        if not p['highSym']:
+            args += ['--tries=%(numberOfModels)d', '--iter=%(numberOfIterations)d']
+            if p['randOrient']:
+                args.append('--randorient')
+            if p['autoMaskExp'] != -1:
+                args.append('--automaskexpand=%(autoMaskExp)d')
+            if p['useMpi']:
+                args.append('--parallel=mpi:%(mpis)d:%(scratch)s')
             else:
-                args += ' --parallel=thread:%(threads)d'
+                args.append('--parallel=thread:%(threads)d')
         else:
-            args += ' --threads=%(threads)d'
-        if self.extraParams.hasValue():
-            args += " " + self.extraParams.get()
+            args.append('--threads=%(threads)d')
+
+        args = ' '.join(args) % p
+        if p['extraParams']:
+            args += ' ' + p['extraParams']
 
-        self._insertFunctionStep('createInitialModelStep', args % self._params)
+        self._insertFunctionStep('createInitialModelStep', args)
 
     # --------------------------- STEPS functions -----------------------------
     def createStackImgsStep(self):
-        if isinstance(self.inputSet.get(), SetOfClasses2D):
-            pixSize = self.inputSet.get().getImages().getSamplingRate()
-            imgSet = self._createSetOfParticles("_averages")
-            for i, cls in enumerate(self.inputSet.get()):
-                img = cls.getRepresentative()
-                img.setSamplingRate(pixSize)
-                img.setObjId(i + 1)
-                imgSet.append(img)
+        """ Write the input images into an hdf stack. The pixel size
+        is stored in the header of each image, so no extra
+        e2proc2d.py conversion is needed. """
+        imgsFn = self._params['imgsFn']
+        cleanPath(imgsFn)
+        inputSet = self.inputSet.get()
+        if isinstance(inputSet, SetOfClasses2D):
+            convertReferences(iterRepresentatives(inputSet), imgsFn)
         else:
-            imgSet = self.inputSet.get()
-            pixSize = imgSet.getSamplingRate()
-
-        tmpStack = self._getTmpPath("averages.spi")
-        imgSet.writeStack(tmpStack)
-        orig = os.path.relpath(tmpStack,
-                               self._getExtraPath())
-        args = "%s %s --apix=%0.3f" % (orig, self._params['relImgsFn'], pixSize)
-        self.runJob(Plugin.getProgram('e2proc2d.py'), args,
-                    cwd=self._getExtraPath(),
-                    numberOfMpi=1, numberOfThreads=1)
+            convertReferences(inputSet, imgsFn)
 
     def createInitialModelStep(self, args):
         """ Run the EMAN program to create the initial model. """
-        cleanPattern(self._getExtraPath('initial_models'))
+        cleanPath(self._getExtraPath('initial_models'))
         if self._isHighSym():
             program = Plugin.getProgram('e2initialmodel_hisym.py')
         else:
@@ -180,13 +178,13 @@ class EmanProtInitModel(ProtInitialVolume):
                     numberOfMpi=1, numberOfThreads=1)
 
     def createOutputStep(self):
-        classes2DSet = self.inputSet.get()
+        inputSet = self.inputSet.get()
         volumes = self._createSetOfVolumes()
         shrink = self.shrink.get()
-        if isinstance(self.inputSet.get(), SetOfClasses2D):
-            volumes.setSamplingRate(classes2DSet.getImages().getSamplingRate() * shrink)
+        if isinstance(inputSet, SetOfClasses2D):
+            volumes.setSamplingRate(inputSet.getImages().getSamplingRate() * shrink)
         else:
-            volumes.setSamplingRate(self.inputSet.get().getSamplingRate() * shrink)
+            volumes.setSamplingRate(inputSet.getSamplingRate() * shrink)
         outputVols = self._getVolumes()
         for k, volFn in enumerate(outputVols):
             vol = Volume()
@@ -224,15 +222,41 @@ class EmanProtInitModel(ProtInitialVolume):
                         'symmetry': self.symmetry.get(),
                         'threads': self.numberOfThreads.get(),
                         'mpis': self.numberOfMpi.get(),
-                        'scratch': Plugin.getVar(EMAN2SCRATCHDIR)}
+                        'useMpi': self.numberOfMpi.get() > 1,
+                        'scratch': self._getScratchDir(),
+                        'randOrient': self.randOrient.get(),
+                        'autoMaskExp': self.autoMaskExp.get(),
+                        'highSym': self.symmetry.get() in _HIGH_SYM,
+                        'extraParams': self.extraParams.get('')}
+
+    def _getScratchDir(self):
+        """ Use the RAM disk for the MPI scratch files when
+        EMAN2SCRATCHDIR was not set by the user. The free space is only
+        checked on the node running the protocol, an MPI run spanning
+        several nodes relies on /dev/shm being large enough on all of them.
+        """
+        if (EMAN2SCRATCHDIR not in os.environ and os.path.isdir(SHM_SCRATCHDIR)
+                and shutil.disk_usage(SHM_SCRATCHDIR).free > SHM_MIN_FREE):
+            return SHM_SCRATCHDIR
+
+        return Plugin.getVar(EMAN2SCRATCHDIR)
 
     def _isHighSym(self):
-        return self.symmetry.get() in ["oct", "tet", "icos"]
+        """ Use the value cached by _prepareDefinition, that is not
+        called when the protocol is loaded for the summary. """
+        if hasattr(self, '_params'):
+            return self._params['highSym']
+
+        return self.symmetry.get() in _HIGH_SYM
 
     def _getVolumes(self):
+        """ Return the sorted list of output volumes. """
         if self._isHighSym():
-            outputVols = [self._getExtraPath('final.hdf')]
-        else:
-            outputVols = glob(self._getExtraPath('initial_models/model_??_??.hdf'))
-            outputVols.sort()
-        return outputVols
+            return [self._getExtraPath('final.hdf')]
+
+        modelsDir = self._getExtraPath('initial_models')
+        if not os.path.isdir(modelsDir):
+            return []
+        modelRegex = re.compile(r'model_\d{2}_\d{2}\.hdf$')
+        with os.scandir(modelsDir) as it:
+            return sorted(e.path for e in it if modelRegex.match(e.name))
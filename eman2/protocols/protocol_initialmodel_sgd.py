@@ -24,18 +24,20 @@
 # *
 # **************************************************************************
 
-from glob import glob
+import os
+import re
 from enum import Enum
 
-from pyworkflow.utils.path import cleanPattern
+from pyworkflow.utils.path import cleanPattern, cleanPath
 from pyworkflow.constants import PROD
 from pyworkflow.protocol.params import (PointerParam, IntParam,
                                         BooleanParam, StringParam,
                                         EnumParam, FloatParam)
 from pwem.protocols import ProtInitialVolume
-from pwem.objects.data import SetOfClasses2D, SetOfAverages, Volume, SetOfVolumes
+from pwem.objects.data import SetOfClasses2D, Volume, SetOfVolumes
 
 from .. import Plugin
+from ..convert import convertReferences, iterRepresentatives
 from ..constants import SGD_INPUT_AVG, SGD_INPUT_PTCLS
 
 
@@ -150,44 +152,40 @@ class EmanProtInitModelSGD(ProtInitialVolume):
         self._insertFunctionStep('createOutputStep')
 
     def _insertInitialModelStep(self):
-        args = '--ptcls=input_set.spi'
-        if self.shrink > 1:
-            args += ' --shrink=%(shrink)d'
+        p = self._params
+        args = ['--ptcls=%(relImgsFn)s']
+        if p['shrink'] > 1:
+            args.append('--shrink=%(shrink)d')
 
-        args += ' --ntry=%(numberOfModels)d --niter=%(numberOfIterations)d'
-        args += ' --batchsize=%(batchSize)d --targetres=%(targetRes)f'
-        args += ' --learnrate=%(learnRate)f --lrdecay=%(lrDecay)f'
-        args += ' --addnoise %(addNoise)f --sym=%(symmetry)s'
+        args += ['--ntry=%(numberOfModels)d', '--niter=%(numberOfIterations)d',
+                 '--batchsize=%(batchSize)d', '--targetres=%(targetRes)f',
+                 '--learnrate=%(learnRate)f', '--lrdecay=%(lrDecay)f',
+                 '--addnoise %(addNoise)f', '--sym=%(symmetry)s']
 
-        if self.writeTmp:
-            args += ' --writetmp'
-        if self.fullCov:
-            args += ' --fullcov'
+        if p['writeTmp']:
+            args.append('--writetmp')
+        if p['fullCov']:
+            args.append('--fullcov')
 
-        args += ' --threads=%(threads)d'
+        args.append('--threads=%(threads)d')
 
-        if self.extraParams.hasValue():
-            args += " " + self.extraParams.get()
+        args = ' '.join(args) % p
+        if p['extraParams']:
+            args += ' ' + p['extraParams']
 
-        self._insertFunctionStep('createInitialModelStep', args % self._params)
+        self._insertFunctionStep('createInitialModelStep', args)
 
     # --------------------------- STEPS functions -----------------------------
     def createStackImgsStep(self):
+        """ Write the input images into an hdf stack,
+        the format EMAN reads natively. """
         imgsFn = self._params['imgsFn']
+        cleanPath(imgsFn)
         inputSet = self._getInputSet()
         if isinstance(inputSet, SetOfClasses2D):
-            imgSet = self._createSetOfParticles("_averages")
-            for i, cls in enumerate(self.inputAvg.get()):
-                img = cls.getRepresentative()
-                img.setSamplingRate(cls.getSamplingRate())
-                img.setObjId(i + 1)
-                imgSet.append(img)
-        elif isinstance(inputSet, SetOfAverages):
-            imgSet = self.inputAvg.get()
+            convertReferences(iterRepresentatives(inputSet), imgsFn)
         else:
-            imgSet = self.inputPart.get()
-
-        imgSet.writeStack(imgsFn)
+            convertReferences(inputSet, imgsFn)
 
     def createInitialModelStep(self, args):
         """ Run the EMAN program to create the initial model. """
@@ -231,7 +229,8 @@ class EmanProtInitModelSGD(ProtInitialVolume):
     # --------------------------- UTILS functions -----------------------------
 
     def _prepareDefinition(self):
-        self._params = {'imgsFn': self._getExtraPath('input_set.spi'),
+        self._params = {'imgsFn': self._getExtraPath('input_set.hdf'),
+                        'relImgsFn': 'input_set.hdf',
                         'numberOfIterations': self.numberOfIterations.get(),
                         'numberOfModels': self.numberOfModels.get(),
                         'shrink': self.shrink.get(),
@@ -241,10 +240,23 @@ class EmanProtInitModelSGD(ProtInitialVolume):
                         'targetRes': self.targetRes.get(),
                         'learnRate': self.learnRate.get(),
                         'lrDecay': self.lrDecay.get(),
-                        'addNoise': self.addNoise.get()}
+                        'addNoise': self.addNoise.get(),
+                        'writeTmp': self.writeTmp.get(),
+                        'fullCov': self.fullCov.get(),
+                        'extraParams': self.extraParams.get('')}
 
     def _getVolumes(self):
-        outputVols = glob(self._getExtraPath('initmodel_??/model_??.hdf'))
+        runRegex = re.compile(r'initmodel_\d{2}$')
+        modelRegex = re.compile(r'model_\d{2}\.hdf$')
+        outputVols = []
+        if not os.path.isdir(self._getExtraPath()):
+            return outputVols
+        with os.scandir(self._getExtraPath()) as runs:
+            for run in runs:
+                if runRegex.match(run.name) and run.is_dir():
+                    with os.scandir(run.path) as it:
+                        outputVols.extend(e.path for e in it
+                                          if modelRegex.match(e.name))
         outputVols.sort()
 
         return outputVols
@@ -260,71 +260,55 @@ class EmanProtReconstruct(ProtReconstruct3D):
     # --------------------------- UTILS functions -----------------------------
 
     def _prepareParams(self):
-        args = "--input %(imgsFn)s --output %(outputVol)s --sym %(sym)s"
+        args = ['--input %s' % self._getParticlesStack(),
+                '--output %s' % self._getBaseName("volume"),
+                '--sym %s' % self.symmetry.get()]
 
         if self.useE2make3d:
-            args += " --iter %(numberOfIterations)d "
-            args += " --recon %(reconsMethod)s"
-        else:
-            args += " --mode %s" % self.getEnumText('fourierMode')
-            args += " --threads=%d" % self.numberOfThreads.get()
+            reconsMethod = self.getEnumText('reconstructionMethod')
+            if reconsMethod in ['fourier', 'fourier_plane',
+                                'fouriersimple2D', 'wiener_fourier']:
+                reconsMethod += ':mode=' + self.getEnumText('fourierMode')
 
-        if self.extraParams.hasValue():
-            args += ' ' + self.extraParams.get()
-
-        reconsMethod = self.getEnumText('reconstructionMethod')
-        if (reconsMethod == 'fourier' or reconsMethod == 'fourier_plane' or
-                reconsMethod == 'fouriersimple2D' or
-                reconsMethod == 'wiener_fourier'):
-            reconsMethod = reconsMethod + ':mode=' + self.getEnumText('fourierMode')
-
-        params = {'imgsFn': self._getParticlesStack(),
-                  'outputVol': self._getBaseName("volume"),
-                  'numberOfIterations': self.numberOfIterations.get(),
-                  'sym': self.symmetry.get(),
-                  'reconsMethod': reconsMethod
-                  }
-
-        args %= params
-
-        if self.padX.get() > 0:
-            if self.padY.get() <= 0 or self.padX.get() == self.padY.get():
-                args += " --pad %d" % self.padX.get()
-            else:
-                args += " --pad %d,%d" % (self.padX.get(), self.padY.get())
-
-        if self.dimVolX.get() > 0:
-            if ((self.dimVolY.get() <= 0 and self.dimVolZ.get() <= 0) or
-                    (self.dimVolY.get() == self.dimVolX.get() and
-                     self.dimVolZ.get() == self.dimVolX.get())):
-                args += " --padvol %d" % self.dimVolX.get()
-            else:
-                args += " --padvol %d,%d,%d" % (self.dimVolX.get(),
-                                                self.dimVolY.get(),
-                                                self.dimVolZ.get())
-
-        if self.dimWriteVolX.get() > 0:
-            if ((self.dimWriteVolY.get() <= 0 and self.dimWriteVolZ.get() <= 0) or
-                    (self.dimWriteVolY.get() == self.dimWriteVolX.get() and
-                     self.dimWriteVolZ.get() == self.dimWriteVolX.get())):
-                args += " --outsize %d" % self.dimWriteVolX.get()
-            else:
-                args += " --outsize %d,%d,%d" % (self.dimWriteVolX.get(),
-                                                 self.dimWriteVolY.get(),
-                                                 self.dimWriteVolZ.get())
+            args.append('--iter %d' % self.numberOfIterations.get())
+            args.append('--recon %s' % reconsMethod)
+        else:
+            args.append('--mode %s' % self.getEnumText('fourierMode'))
+            args.append('--threads=%d' % self.numberOfThreads.get())
+
+        dims = [('pad', self.padX.get(), self.padY.get()),
+                ('padvol', self.dimVolX.get(), self.dimVolY.get(),
+                 self.dimVolZ.get()),
+                ('outsize', self.dimWriteVolX.get(), self.dimWriteVolY.get(),
+                 self.dimWriteVolZ.get())]
+        for flag, *values in dims:
+            if values[0] > 0:
+                args.append(self._getDimArg(flag, *values))
 
         if self.keepSense == KEEP_STDDEV:
-            args += "  --keep %f --keepsig" % self.keep.get()
+            args.append('--keep %f --keepsig' % self.keep.get())
         elif self.keepSense == KEEP_ABSQUAL:
-            args += "  --keep %f --keepabs" % self.keep.get()
+            args.append('--keep %f --keepabs' % self.keep.get())
 
         if self.keep.get() != 1.0 and self.keepSense == KEEP_PERCENTAGE:
-            args += " --keep %f" % self.keep.get()
+            args.append('--keep %f' % self.keep.get())
 
         if self.doNotAutoWt:
-            args += " --no_wt"
+            args.append('--no_wt')
+
+        if self.extraParams.hasValue():
+            args.append(self.extraParams.get())
+
+        return ' '.join(args)
+
+    def _getDimArg(self, flag, first, *others):
+        """ Return the option for the given dimensions. A single value
+        is passed when the others are not set or equal to the first. """
+        if (all(d <= 0 for d in others) or
+                all(d == first for d in others)):
+            return '--%s %d' % (flag, first)
 
-        return args
+        return '--%s %s' % (flag, ','.join(str(d) for d in (first,) + others))
 
     def _getBaseName(self, key):
         """ Remove the folders and return the file from the filename. """
@@ -41,15 +41,22 @@ from pyworkflow.utils.path import makePath, cleanPath, createLink
 
 from .. import Plugin
 from ..convert import (rowToAlignment, writeSetOfParticles,
-                       convertReferences)
+                       convertReferences, loadResultsFile)
 from ..constants import *
+from .protocol_base import (EmanFileNamesMixin, EmanIterClassesMixin,
+                            scanIterations)
+
+# Iterations will be identify by classes_XX.hdf where XX is the iteration
+#  number and is restricted to only 2 digits.
+_ITER_REGEX = re.compile(r'classes_(\d{2})\.hdf')
 
 
 class outputs(Enum):
     outputClasses = SetOfClasses2D
 
 
-class EmanProtRefine2D(ProtClassify2D):
+class EmanProtRefine2D(EmanFileNamesMixin, EmanIterClassesMixin,
+                       ProtClassify2D):
     """
     This protocol wraps *e2refine2d.py* EMAN2 program.
 
@@ -78,6 +85,12 @@ class EmanProtRefine2D(ProtClassify2D):
     _devStatus = PROD
     _possibleOutputs = outputs
 
+    def __init__(self, **kwargs):
+        ProtClassify2D.__init__(self, **kwargs)
+        self._cachedRun = None
+        self._cachedIt = None
+        self._cachedIters = None
+
     def _createFilenameTemplates(self):
         """ Centralize the names of the files. """
 
@@ -96,12 +109,10 @@ class EmanProtRefine2D(ProtClassify2D):
         self._updateFilenamesDict(myDict)
 
     def _createIterTemplates(self, currRun):
-        """ Setup the regex on how to find iterations. """
+        """ Setup the folder where the iterations are found. """
         clsFn = self._getExtraPath(self._getFileName('classes', run=currRun, iter=1))
-        self._iterTemplate = clsFn.replace('classes_01', 'classes_??')
-        # Iterations will be identify by classes_XX_ where XX is the iteration
-        #  number and is restricted to only 2 digits.
-        self._iterRegex = re.compile(r'classes_(\d{2})')
+        self._runDir = os.path.dirname(clsFn)
+        self._cachedIters = None
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -383,7 +394,8 @@ class EmanProtRefine2D(ProtClassify2D):
         partAlign = partSet.getAlignment()
         storePath = self._getExtraPath("particles")
         makePath(storePath)
-        writeSetOfParticles(partSet, storePath, alignType=partAlign)
+        writeSetOfParticles(partSet, storePath, alignType=partAlign,
+                            threads=self.numberOfThreads.get())
 
         if not self.skipctf:
             program = Plugin.getProgram('e2ctf.py')
@@ -415,6 +427,8 @@ class EmanProtRefine2D(ProtClassify2D):
         # mpi and threads are handled by EMAN itself
         self.runJob(program, args, cwd=self._getExtraPath(),
                     numberOfMpi=1, numberOfThreads=1)
+        # new iterations were written, list them again
+        self._cachedIters = None
 
     def createOutputStep(self):
         partSet = self._getInputParticles(pointer=True)
@@ -516,26 +530,32 @@ class EmanProtRefine2D(ProtClassify2D):
         return args
 
     def _getRun(self):
+        """ Return the number of the r2d_XX folder of this run. It only
+        depends on the previous run, so it is computed once. """
         if not self.doContinue:
             return 0
-        else:
+
+        if self._cachedRun is None:
             contRun = self.continueRun.get()
             files = sorted(glob(contRun._getExtraPath("r2d_??")))
             if files:
-                f = files[-1]
-                runNumber = int(f.split("_")[-1]) + 1
-                return runNumber
+                self._cachedRun = int(files[-1].split("_")[-1]) + 1
+
+        return self._cachedRun
 
     def _getIt(self):
-        contRun = self.continueRun.get()
-        runN = self._getRun()
-        files = sorted(glob(contRun._getExtraPath("r2d_%02d/classes_??.hdf" % runN)))
-        if files:
-            i = files[-1]
-            iterNumber = int(i.split("_")[-1].replace('.hdf', ''))
-            return iterNumber
-        else:
-            return 1
+        """ Return the last iteration of the previous run. """
+        if self._cachedIt is None:
+            contRun = self.continueRun.get()
+            runN = self._getRun()
+            files = sorted(glob(contRun._getExtraPath("r2d_%02d/classes_??.hdf" % runN)))
+            if files:
+                i = files[-1]
+                self._cachedIt = int(i.split("_")[-1].replace('.hdf', ''))
+            else:
+                self._cachedIt = 1
+
+        return self._cachedIt
 
     def _getBaseName(self, key, **args):
         """ Remove the folders and return the file from the filename. """
@@ -548,22 +568,16 @@ class EmanProtRefine2D(ProtClassify2D):
             return self._getFileName("partSet")
 
     def _iterTextFile(self, iterN):
-        with open(self._getFileName('results', iter=iterN)) as f:
-            for line in f:
-                if '#' not in line and line.strip():
-                    yield [float(x) for x in line.split()]
+        return iter(loadResultsFile(self._getFileName('results', iter=iterN), 8))
 
     def _getIterNumber(self, index):
-        """ Return the list of iteration files, give the iterTemplate. """
-        result = None
-        files = sorted(glob(self._iterTemplate))
-        if files:
-            f = files[index]
-            s = self._iterRegex.search(f)
-            if s:
-                result = int(s.group(1))  # group 1 is 2 digits iteration number
+        """ Return the iteration at the given index of the sorted
+        iterations found in the run folder. """
+        if self._cachedIters is None:
+            self._cachedIters = scanIterations(self._runDir, _ITER_REGEX)
+        iters = self._cachedIters
 
-        return result
+        return iters[index] if iters else None
 
     def _lastIter(self):
         return self._getIterNumber(-1)
@@ -571,7 +585,7 @@ class EmanProtRefine2D(ProtClassify2D):
     def _firstIter(self):
         return self._getIterNumber(0) or 1
 
-    def _getIterClasses(self, it, clean=False):
+    def _getIterClasses(self, it, clean=False, convert=True):
         """ Return a classes .sqlite file for this iteration.
         If the file doesn't exists, it will be created by
         converting from this iteration data.star file.
@@ -584,7 +598,7 @@ class EmanProtRefine2D(ProtClassify2D):
         if not os.path.exists(data_classes):
             clsSet = SetOfClasses2D(filename=data_classes)
             clsSet.setImages(self._getInputParticles(pointer=True))
-            self._fillClassesFromIter(clsSet, it)
+            self._fillClassesFromIter(clsSet, it, convert)
             clsSet.write()
             clsSet.close()
 
@@ -598,8 +612,11 @@ class EmanProtRefine2D(ProtClassify2D):
         else:
             return self.inputParticles.get()
 
-    def _fillClassesFromIter(self, clsSet, iterN):
-        self._execEmanProcess(self._getRun(), iterN)
+    def _fillClassesFromIter(self, clsSet, iterN, convert=True):
+        if convert:
+            self._execEmanProcess(self._getRun(), iterN)
+        else:
+            self._setClassesInfo(self._getRun(), iterN)
         params = {'orderBy': ['_micId', 'id'],
                   'direction': 'ASC'}
         clsSet.classifyItems(updateItemCallback=self._updateParticle,
@@ -608,15 +625,23 @@ class EmanProtRefine2D(ProtClassify2D):
                              iterParams=params)
 
     def _execEmanProcess(self, numRun, iterN):
+        self._waitEmanProcesses([self._startEmanProcess(iterN)])
+        self._setClassesInfo(numRun, iterN)
+
+    def _startEmanProcess(self, iterN):
+        """ Launch the conversion of the EMAN results of an iteration
+        to a text file, without waiting for it to finish. """
+        numRun = self._getRun()
         clsFn = self._getFileName("cls", run=numRun, iter=iterN)
         classesFn = self._getFileName("classes", run=numRun, iter=iterN)
 
-        proc = Plugin.createEmanProcess(args='read %s %s %s %s 2d'
+        return Plugin.createEmanProcess(args='read %s %s %s %s 2d'
                                              % (self._getParticlesStack(), clsFn, classesFn,
                                                 self._getBaseName('results', iter=iterN)),
                                         direc=self._getExtraPath())
-        proc.wait()
 
+    def _setClassesInfo(self, numRun, iterN):
+        classesFn = self._getFileName("classes", run=numRun, iter=iterN)
         self._classesInfo = {}  # store classes info, indexed by class id
         for classId in range(self.numberOfClassAvg.get()):
             self._classesInfo[classId + 1] = (classId + 1,
@@ -637,7 +662,7 @@ class EmanProtRefine2D(ProtClassify2D):
 
     def _updateParticle(self, item, row):
         if row[1] == 1:  # enabled
-            item.setClassId(row[2] + 1)
+            item.setClassId(int(row[2]) + 1)
             item.setTransform(rowToAlignment(row[3:], ALIGN_2D))
         else:
             setattr(item, "_appendItem", False)
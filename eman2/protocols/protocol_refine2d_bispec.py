@@ -26,7 +26,6 @@
 
 import os
 import re
-from glob import glob
 from enum import Enum
 
 from pwem.objects import SetOfClasses2D
@@ -39,14 +38,28 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
 from pyworkflow.utils import createLink, cleanPath
 
 from .. import Plugin
+from ..convert import loadResultsFile
 from ..constants import *
+from .protocol_base import (EmanFileNamesMixin, EmanIterClassesMixin,
+                            scanIterations)
+
+# Iterations will be identify by classes_XX.hdf where XX is the iteration
+#  number and is restricted to only 2 digits.
+_ITER_REGEX = re.compile(r'classes_(\d{2})\.hdf')
+
+# particle set and output used for each ctf processing type,
+#  any other type uses the lp12 ones
+_STACK_KEYS = {HIRES: 'partSetFlipLp5', MIDRES: 'partSetFlipLp7'}
+_OUTPUT_NAMES = {HIRES: 'outputParticles_flip_lp5',
+                 MIDRES: 'outputParticles_flip_lp7'}
 
 
 class outputs(Enum):
     outputClasses = SetOfClasses2D
 
 
-class EmanProtRefine2DBispec(ProtClassify2D):
+class EmanProtRefine2DBispec(EmanFileNamesMixin, EmanIterClassesMixin,
+                             ProtClassify2D):
     """
     This protocol wraps *e2refine2d_bispec.py* EMAN2 program.
 
@@ -67,6 +80,11 @@ class EmanProtRefine2DBispec(ProtClassify2D):
     _devStatus = PROD
     _possibleOutputs = outputs
 
+    def __init__(self, **kwargs):
+        ProtClassify2D.__init__(self, **kwargs)
+        self._cachedIters = None
+        self._cachedStack = None
+
     def _createFilenameTemplates(self):
         """ Centralize the names of the files. """
 
@@ -87,12 +105,10 @@ class EmanProtRefine2DBispec(ProtClassify2D):
         self._updateFilenamesDict(myDict)
 
     def _createIterTemplates(self, currRun):
-        """ Setup the regex on how to find iterations. """
+        """ Setup the folder where the iterations are found. """
         clsFn = self._getExtraPath(self._getFileName('classes', run=currRun, iter=1))
-        self._iterTemplate = clsFn.replace('classes_01', 'classes_??')
-        # Iterations will be identify by classes_XX_ where XX is the iteration
-        #  number and is restricted to only 2 digits.
-        self._iterRegex = re.compile(r'classes_(\d{2})')
+        self._runDir = os.path.dirname(clsFn)
+        self._cachedIters = None
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -256,6 +272,8 @@ class EmanProtRefine2DBispec(ProtClassify2D):
         # mpi and threads are handled by EMAN itself
         self.runJob(program, args, cwd=self._getExtraPath(),
                     numberOfMpi=1, numberOfThreads=1)
+        # new iterations were written, list them again
+        self._cachedIters = None
 
     def createOutputStep(self):
         partSet = self._getInputParticles()
@@ -342,34 +360,33 @@ class EmanProtRefine2DBispec(ProtClassify2D):
         return os.path.basename(self._getFileName(key, **args))
 
     def _getParticlesStack(self):
-        protType = self._inputProt().type.get()
-        if protType == HIRES:
-            return "sets/" + os.path.basename(self._getFileName("partSetFlipLp5"))
-        elif protType == MIDRES:
-            return "sets/" + os.path.basename(self._getFileName("partSetFlipLp7"))
-        else:
-            return "sets/" + os.path.basename(self._getFileName("partSetFlipLp12"))
+        if self._cachedStack is None:
+            protType = self._inputProt().type.get()
+            key = _STACK_KEYS.get(protType, 'partSetFlipLp12')
+            self._cachedStack = "sets/" + self._getBaseName(key)
+
+        return self._cachedStack
 
     def _iterTextFile(self, iterN):
-        with open(self._getFileName('results', iter=iterN)) as f:
-            for line in f:
-                if '#' not in line and line.strip():
-                    yield [float(x) for x in line.split()]
+        """ Iterate the (enabled, classId) pairs of the particles,
+        computed for the whole results file at once. """
+        results = loadResultsFile(self._getFileName('results', iter=iterN), 8)
+        enabled = (results[:, 1] == 1).tolist()
+        classIds = (results[:, 2].astype(int) + 1).tolist()
+
+        return zip(enabled, classIds)
 
     def _getRun(self):
         return 0
 
     def _getIterNumber(self, index):
-        """ Return the list of iteration files, give the iterTemplate. """
-        result = None
-        files = sorted(glob(self._iterTemplate))
-        if files:
-            f = files[index]
-            s = self._iterRegex.search(f)
-            if s:
-                result = int(s.group(1))  # group 1 is 2 digits iteration number
+        """ Return the iteration at the given index of the sorted
+        iterations found in the run folder. """
+        if self._cachedIters is None:
+            self._cachedIters = scanIterations(self._runDir, _ITER_REGEX)
+        iters = self._cachedIters
 
-        return result
+        return iters[index] if iters else None
 
     def _lastIter(self):
         return self._getIterNumber(-1)
@@ -377,7 +394,7 @@ class EmanProtRefine2DBispec(ProtClassify2D):
     def _firstIter(self):
         return self._getIterNumber(0) or 1
 
-    def _getIterClasses(self, it, clean=False):
+    def _getIterClasses(self, it, clean=False, convert=True):
         """ Return a classes .sqlite file for this iteration.
         If the file doesn't exist, it will be created by
         converting from this iteration data.star file.
@@ -390,7 +407,7 @@ class EmanProtRefine2DBispec(ProtClassify2D):
         if not os.path.exists(data_classes):
             clsSet = SetOfClasses2D(filename=data_classes)
             clsSet.setImages(self._getInputParticles())
-            self._fillClassesFromIter(clsSet, it)
+            self._fillClassesFromIter(clsSet, it, convert)
             clsSet.write()
             clsSet.close()
 
@@ -398,18 +415,15 @@ class EmanProtRefine2DBispec(ProtClassify2D):
 
     def _getInputParticles(self):
         prot = self._inputProt()
-        protType = prot.type.get()
-        if protType == HIRES:
-            output = getattr(prot, "outputParticles_flip_lp5")
-        elif protType == MIDRES:
-            output = getattr(prot, "outputParticles_flip_lp7")
-        else:
-            output = getattr(prot, "outputParticles_flip_lp12")
-
-        return output
+        outputName = _OUTPUT_NAMES.get(prot.type.get(),
+                                       'outputParticles_flip_lp12')
+        return getattr(prot, outputName)
 
-    def _fillClassesFromIter(self, clsSet, iterN):
-        self._execEmanProcess(iterN)
+    def _fillClassesFromIter(self, clsSet, iterN, convert=True):
+        if convert:
+            self._execEmanProcess(iterN)
+        else:
+            self._setClassesInfo(iterN)
         params = {'orderBy': ['_micId', 'id'],
                   'direction': 'ASC'}
         clsSet.classifyItems(updateItemCallback=self._updateParticle,
@@ -418,20 +432,26 @@ class EmanProtRefine2DBispec(ProtClassify2D):
                              iterParams=params)
 
     def _execEmanProcess(self, iterN):
+        self._waitEmanProcesses([self._startEmanProcess(iterN)])
+        self._setClassesInfo(iterN)
+
+    def _startEmanProcess(self, iterN):
+        """ Launch the conversion of the EMAN results of an iteration
+        to a text file, without waiting for it to finish. """
         runN = self._getRun()
         clsFn = self._getFileName("cls", run=runN, iter=iterN)
         classesFn = self._getFileName("classes", run=runN, iter=iterN)
 
-        proc = Plugin.createEmanProcess(args='read %s %s %s %s 2d'
+        return Plugin.createEmanProcess(args='read %s %s %s %s 2d'
                                              % (self._getParticlesStack(), clsFn, classesFn,
                                                 self._getBaseName('results', iter=iterN)),
                                         direc=self._getExtraPath())
-        proc.wait()
 
-        self._classesInfo = {}  # store classes info, indexed by class id
-        for classId in range(self.numberOfClassAvg.get()):
-            self._classesInfo[classId + 1] = (classId + 1,
-                                              self._getExtraPath(classesFn))
+    def _setClassesInfo(self, iterN):
+        classesFn = self._getFileName("classes", run=self._getRun(), iter=iterN)
+        # classes are numbered 1..N inside a single stack
+        self._numClasses = self.numberOfClassAvg.get()
+        self._classesFn = self._getExtraPath(classesFn)
 
     def _getOptsString(self, option):
         optionType = self.getEnumText(option + 'Type')
@@ -447,16 +467,16 @@ class EmanProtRefine2DBispec(ProtClassify2D):
         return argStr
 
     def _updateParticle(self, item, row):
-        if row[1] == 1:  # enabled
-            item.setClassId(row[2] + 1)
+        enabled, classId = row
+        if enabled:
+            item.setClassId(classId)
         else:
             setattr(item, "_appendItem", False)
 
     def _updateClass(self, item):
         classId = item.getObjId()
-        if classId in self._classesInfo:
-            _, fn = self._classesInfo[classId]
-            item.getRepresentative().setLocation(classId, fn)
+        if 1 <= classId <= self._numClasses:
+            item.getRepresentative().setLocation(classId, self._classesFn)
 
     def _inputProt(self):
         return self.inputBispec.get()
@@ -26,21 +26,28 @@
 
 import os
 import re
-from glob import glob
+import fcntl
 from enum import Enum
 
 from pwem.constants import ALIGN_PROJ
 from pwem.protocols import ProtRefine3D
-from pwem.objects.data import Volume, SetOfParticles
+from pwem.objects.data import Volume, SetOfParticles, Transform
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pyworkflow.constants import PROD
 from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
                                         EnumParam, StringParam, BooleanParam)
-from pyworkflow.utils.path import cleanPattern, makePath, createLink
+from pyworkflow.utils.path import (cleanPath, cleanPattern, makePath,
+                                   createLink)
 
 from .. import Plugin
-from ..convert import rowToAlignment, writeSetOfParticles
+from ..convert import (rowsToMatrices, writeSetOfParticles,
+                       loadResultsFile)
 from ..constants import TOPHAT_NONE, SPEED_5, AMP_AUTO, EMAN2SCRATCHDIR
+from .protocol_base import EmanFileNamesMixin, scanIterations
+
+# Iterations will be identify by threed_XX.hdf where XX is the iteration
+#  number and is restricted to only 2 digits.
+_ITER_REGEX = re.compile(r'threed_(\d{2})\.hdf')
 
 
 class outputs(Enum):
@@ -48,7 +55,7 @@ class outputs(Enum):
     outputParticles = SetOfParticles
 
 
-class EmanProtRefine(ProtRefine3D):
+class EmanProtRefine(EmanFileNamesMixin, ProtRefine3D):
     """
     This protocol wraps *e2refine_easy.py* EMAN2 program.
 
@@ -74,12 +81,18 @@ Major features of this program:
     _devStatus = PROD
     _possibleOutputs = outputs
 
+    def __init__(self, **kwargs):
+        ProtRefine3D.__init__(self, **kwargs)
+        self._cachedRun = None
+        self._cachedIters = None
+
     def _createFilenameTemplates(self):
         """ Centralize the names of the files. """
 
         myDict = {
             'partSet': 'sets/inputSet.lst',
             'partFlipSet': 'sets/inputSet__ctf_flip.lst',
+            'partSignature': self._getExtraPath('particles_signature.txt'),
             'data_scipion': self._getExtraPath('data_scipion_it%(iter)02d.sqlite'),
             'projections': self._getExtraPath('projections_it%(iter)02d_%(half)s.sqlite'),
             'classes': 'refine_%(run)02d/classes_%(iter)02d',
@@ -102,13 +115,10 @@ Major features of this program:
         self._updateFilenamesDict(myDict)
 
     def _createIterTemplates(self, currRun):
-        """ Setup the regex on how to find iterations. """
-        self._iterTemplate = self._getFileName('mapFull', run=currRun,
-                                               iter=1).replace('threed_01',
-                                                               'threed_??')
-        # Iterations will be identify by threed_XX_ where XX is the iteration
-        # number and is restricted to only 2 digits.
-        self._iterRegex = re.compile(r'threed_(\d{2})')
+        """ Setup the folder where the iterations are found. """
+        self._runDir = os.path.dirname(self._getFileName('mapFull',
+                                                         run=currRun, iter=1))
+        self._cachedIters = None
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -288,7 +298,13 @@ Major features of this program:
         partAlign = partSet.getAlignment()
         storePath = self._getExtraPath("particles")
         makePath(storePath)
-        writeSetOfParticles(partSet, storePath, alignType=partAlign)
+        signature = self._getInputSignature(partSet)
+        signatureFn = self._getFileName('partSignature')
+        if self._readSignature(signatureFn) != signature:
+            writeSetOfParticles(partSet, storePath, alignType=partAlign)
+            # written only after a complete conversion
+            with open(signatureFn, 'w') as f:
+                f.write(signature)
         if not self.skipctf:
             program = Plugin.getProgram('e2ctf.py')
             acq = partSet.getAcquisition()
@@ -317,21 +333,23 @@ Major features of this program:
         # mpi and threads are handled by EMAN itself
         self.runJob(program, args, cwd=self._getExtraPath(),
                     numberOfMpi=1, numberOfThreads=1)
+        self._cachedIters = None
 
     def createOutputStep(self):
         iterN = self.numberOfIterations.get()
         partSet = self._getInputParticles(pointer=True)
         numRun = self._getRun()
+        inputSet = partSet.get()
 
         vol = Volume()
         vol.setFileName(self._getFileName("mapFull", run=numRun, iter=iterN))
         halfMap1 = self._getFileName("mapEvenUnmasked", run=numRun)
         halfMap2 = self._getFileName("mapOddUnmasked", run=numRun)
         vol.setHalfMaps([halfMap1, halfMap2])
-        vol.copyInfo(partSet.get())
+        vol.copyInfo(inputSet)
 
         newPartSet = self._createSetOfParticles()
-        newPartSet.copyInfo(partSet.get())
+        newPartSet.copyInfo(inputSet)
         self._fillDataFromIter(newPartSet, iterN)
 
         self._defineOutputs(**{outputs.outputVolume.name: vol,
@@ -399,69 +417,91 @@ Major features of this program:
         return args
 
     def _commonParams(self):
-        args = " --targetres=%(resol)f --speed=%(speed)d --sym=%(sym)s "
-        args += " --iter=%(numberOfIterations)d --mass=%(molMass)f "
-        args += " --apix=%(samplingRate)f --classkeep=%(classKeep)f"
+        samplingRate = self._getInputParticles().getSamplingRate()
+        threads = self.numberOfThreads.get()
+        args = ['--targetres=%f' % self.resol.get(),
+                '--speed=%d' % int(self.getEnumText('speed')),
+                '--sym=%s' % self.symmetry.get(),
+                '--iter=%d' % self.numberOfIterations.get(),
+                '--mass=%f' % self.molMass.get(),
+                '--apix=%f' % samplingRate,
+                '--classkeep=%f' % self.classKeep.get(),
+                '--m3dkeep=%f' % self.m3dKeep.get()]
         if self.numberOfMpi > 1:
-            args += " --m3dkeep=%(m3dKeep)f --parallel=mpi:%(mpis)d:%(scratch)s"
+            scratch = Plugin.getVar(EMAN2SCRATCHDIR)
+            args.append('--parallel=mpi:%d:%s' % (self.numberOfMpi.get(),
+                                                  scratch))
         else:
-            args += " --m3dkeep=%(m3dKeep)f --parallel=thread:%(threads)d"
-        args += " --threads=%(threads)d"
-
-        samplingRate = self._getInputParticles().getSamplingRate()
-        params = {'resol': self.resol.get(),
-                  'speed': int(self.getEnumText('speed')),
-                  'numberOfIterations': self.numberOfIterations.get(),
-                  'sym': self.symmetry.get(),
-                  'molMass': self.molMass.get(),
-                  'samplingRate': samplingRate,
-                  'classKeep': self.classKeep.get(),
-                  'm3dKeep': self.m3dKeep.get(),
-                  'threads': self.numberOfThreads.get(),
-                  'mpis': self.numberOfMpi.get(),
-                  'scratch': Plugin.getVar(EMAN2SCRATCHDIR)
-                  }
-        args %= params
+            args.append('--parallel=thread:%d' % threads)
+        args.append('--threads=%d' % threads)
 
         if self.doBreaksym:
-            args += " --breaksym"
+            args.append('--breaksym')
         if self.useE2make3d:
-            args += " --m3dold"
+            args.append('--m3dold')
         if self.maskExpand.get() != -1:
-            args += " --automaskexpand=%d" % self.maskExpand.get()
+            args.append('--automaskexpand=%d' % self.maskExpand.get())
         if self.useSetsfref:
-            args += " --classrefsf"
+            args.append('--classrefsf')
         if self.doAutomask:
-            args += " --classautomask"
+            args.append('--classautomask')
         if self.doThreshold:
-            args += " --prethreshold"
+            args.append('--prethreshold')
         if self.m3dPostProcess.get() != 'none':
-            args += " --m3dpostprocess=%s" % self.m3dPostProcess.get()
+            args.append('--m3dpostprocess=%s' % self.m3dPostProcess.get())
 
-        args += " --ampcorrect=%s" % self.getEnumText('ampCorrect')
+        args.append('--ampcorrect=%s' % self.getEnumText('ampCorrect'))
 
         if self.tophat != TOPHAT_NONE:
-            args += " --tophat=%s" % self.getEnumText('tophat')
+            args.append('--tophat=%s' % self.getEnumText('tophat'))
 
         if self.useBispec:
-            args += " --invar"
+            args.append('--invar')
 
         if self.noRandPhase:
-            args += " --norandomaphase"
+            args.append('--norandomaphase')
 
         if self.extraParams.hasValue():
-            args += ' ' + self.extraParams.get()
-        return args
+            args.append(self.extraParams.get())
+
+        return ' ' + ' '.join(args)
 
     def _getRun(self):
+        """ Return the number of the refine_XX folder of this run. It only
+        depends on the previous run, so it is computed once. """
         if not self.doContinue:
             return 0
-        else:
-            files = sorted(glob(self.continueRun.get()._getExtraPath("refine*")))
-            if files:
-                f = files[-1]
-                refineNumber = int(f.split("_")[-1]) + 1
-                return refineNumber
+
+        prevExtra = self.continueRun.get()._getExtraPath()
+        if self._cachedRun is None and os.path.isdir(prevExtra):
+            lastRun = None
+            with os.scandir(prevExtra) as it:
+                for entry in it:
+                    name = entry.name
+                    # refine_XX folders, XX being the run number
+                    if name.startswith('refine_') and name[7:].isdigit():
+                        runN = int(name[7:])
+                        if lastRun is None or runN > lastRun:
+                            lastRun = runN
+            if lastRun is not None:
+                self._cachedRun = lastRun + 1
+
+        return self._cachedRun
+
+    def _getInputSignature(self, partSet):
+        """ Identify the converted input, to skip the conversion when
+        the step is executed again with the same particles. """
+        setFn = partSet.getFileName()
+        return '%s %f %d %d %f' % (setFn, os.path.getmtime(setFn),
+                                   partSet.getObjId(), partSet.getSize(),
+                                   partSet.getSamplingRate())
+
+    def _readSignature(self, signatureFn):
+        try:
+            with open(signatureFn) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
 
     def _getBaseName(self, key, **args):
         """ Remove the folders and return the file from the filename. """
@@ -474,29 +514,31 @@ Major features of this program:
             return self._getFileName("partSet")
 
     def _iterTextFile(self, iterN):
-        with open(self._getFileName('angles', iter=iterN)) as f:
-            for line in f:
-                if '#' not in line and line.strip():
-                    yield [float(x) for x in line.split()]
-
-    def _createItemMatrix(self, item, rowList):
-        if rowList[1] == 1:
-            item.setTransform(rowToAlignment(rowList[2:],
-                                             alignType=ALIGN_PROJ))
+        """ Iterate over (enabled, matrix) pairs, one per particle. The
+        transformation matrices of all rows are built at once. """
+        # the particle index in the first column is not needed
+        results = loadResultsFile(self._getFileName('angles', iter=iterN),
+                                  7, firstCol=1)
+        matrices = rowsToMatrices(results[:, 1:], ALIGN_PROJ)
+        return zip(results[:, 0] == 1, matrices)
+
+    def _createItemMatrix(self, item, row):
+        enabled, matrix = row
+        if enabled:
+            transform = Transform()
+            transform.setMatrix(matrix)
+            item.setTransform(transform)
         else:
             setattr(item, "_appendItem", False)
 
     def _getIterNumber(self, index):
-        """ Return the list of iteration files, give the iterTemplate. """
-        result = None
-        files = sorted(glob(self._iterTemplate))
-        if files:
-            f = files[index]
-            s = self._iterRegex.search(f)
-            if s:
-                result = int(s.group(1))  # group 1 is 3 digits iteration number
+        """ Return the iteration at the given index of the sorted
+        iterations found in the run folder. """
+        if self._cachedIters is None:
+            self._cachedIters = scanIterations(self._runDir, _ITER_REGEX)
+        iters = self._cachedIters
 
-        return result
+        return iters[index] if iters else None
 
     def _lastIter(self):
         return self._getIterNumber(-1)
@@ -506,12 +548,24 @@ Major features of this program:
 
     def _getIterData(self, it):
         data_sqlite = self._getFileName('data_scipion', iter=it)
-        if not os.path.exists(data_sqlite):
-            iterImgSet = SetOfParticles(filename=data_sqlite)
-            iterImgSet.copyInfo(self._getInputParticles())
-            self._fillDataFromIter(iterImgSet, it)
-            iterImgSet.write()
-            iterImgSet.close()
+        lockFn = data_sqlite + '.lock'
+        # the lock file is only there while the set is being written
+        if not os.path.exists(data_sqlite) or os.path.exists(lockFn):
+            # several viewers may ask for the same iteration at once,
+            # only one of them should convert it
+            with open(lockFn, 'w') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                if not os.path.exists(data_sqlite):
+                    try:
+                        iterImgSet = SetOfParticles(filename=data_sqlite)
+                        iterImgSet.copyInfo(self._getInputParticles())
+                        self._fillDataFromIter(iterImgSet, it)
+                        iterImgSet.write()
+                        iterImgSet.close()
+                    except Exception:
+                        cleanPath(data_sqlite)  # never leave it half filled
+                        raise
+                cleanPath(lockFn)
 
         return data_sqlite
 
@@ -536,14 +590,17 @@ Major features of this program:
                          itemDataIterator=self._iterTextFile(iterN))
 
     def _execEmanProcess(self, numRun, iterN):
-        clsFn = self._getFileName("cls", run=numRun, iter=iterN)
-        classesFn = self._getFileName("classes", run=numRun, iter=iterN)
+        """ Convert the EMAN results of the iteration into the angles file,
+        unless it is already there or the iteration is not finished. """
         angles = self._getFileName('angles', iter=iterN)
+        if os.path.exists(angles):
+            return
 
-        if not os.path.exists(angles) and os.path.exists(self._getFileName('clsEven',
-                                                                           run=numRun, iter=iterN)):
+        if os.path.exists(self._getFileName('clsEven', run=numRun, iter=iterN)):
+            clsFn = self._getFileName("cls", run=numRun, iter=iterN)
+            classesFn = self._getFileName("classes", run=numRun, iter=iterN)
             proc = Plugin.createEmanProcess(args='read %s %s %s %s 3d'
                                                  % (self._getParticlesStack(), clsFn, classesFn,
-                                                    self._getBaseName('angles', iter=iterN)),
+                                                    os.path.basename(angles)),
                                             direc=self._getExtraPath())
             proc.wait()
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# *  Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy
+
+from pyworkflow.tests import BaseTest
+import pwem.constants as emcts
+
+from eman2.convert import rowToAlignment, rowsToMatrices, loadResultsFile
+
+
+class TestConvertAlignment(BaseTest):
+    """ Check that the vectorized matrices match the ones built
+    one row at a time by rowToAlignment. """
+
+    def _checkMatrices(self, alignType):
+        rng = numpy.random.default_rng(42)
+        rows = numpy.column_stack([rng.uniform(-180, 180, (50, 3)),
+                                   rng.uniform(-20, 20, (50, 2))])
+        # include the identity and a row with zero tilt
+        rows[0] = 0
+        rows[1, 1] = 0
+
+        matrices = rowsToMatrices(rows, alignType)
+        self.assertEqual(matrices.shape, (len(rows), 4, 4))
+        for row, matrix in zip(rows, matrices):
+            expected = rowToAlignment(row, alignType).getMatrix()
+            self.assertTrue(numpy.allclose(matrix, expected, atol=1e-6),
+                            "Matrices differ for row %s" % row)
+
+    def testAlign2D(self):
+        self._checkMatrices(emcts.ALIGN_2D)
+
+    def testAlignProj(self):
+        self._checkMatrices(emcts.ALIGN_PROJ)
+
+
+class TestLoadResultsFile(BaseTest):
+    """ Check the parsing of the results files written by e2converter.py """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _writeResults(self, fn, lines):
+        fn = self.getOutputPath(fn)
+        with open(fn, 'w') as f:
+            f.write('#index, enable, rot, tilt, psi, sx, sy\n')
+            f.write('\n'.join(lines) + '\n')
+        return fn
+
+    def testPaddedRows(self):
+        fn = self._writeResults('padded.txt', ['0 1 10.0 20.0 30.0 1.5 -2.5',
+                                               '1 0 0 0 0 0 0',
+                                               '2 1 40.0 50.0 60.0 0.5 3.0'])
+        results = loadResultsFile(fn, 7)
+        self.assertEqual(results.shape, (3, 7))
+        self.assertTrue(numpy.array_equal(results[1], [1, 0, 0, 0, 0, 0, 0]))
+        self.assertTrue(numpy.allclose(results[2],
+                                       [2, 1, 40.0, 50.0, 60.0, 0.5, 3.0]))
+
+    def testShortDisabledRows(self):
+        # older versions only wrote the index and the enable flag
+        fn = self._writeResults('short.txt', ['0 1 10.0 20.0 30.0 1.5 -2.5',
+                                              '1 0',
+                                              '2 1 40.0 50.0 60.0 0.5 3.0'])
+        results = loadResultsFile(fn, 7)
+        self.assertEqual(results.shape, (3, 7))
+        self.assertTrue(numpy.array_equal(results[1], [1, 0, 0, 0, 0, 0, 0]))
+        self.assertTrue(numpy.allclose(results[0],
+                                       [0, 1, 10.0, 20.0, 30.0, 1.5, -2.5]))
+
+    def testAllRowsDisabled(self):
+        fn = self._writeResults('disabled.txt', ['0 0', '1 0'])
+        results = loadResultsFile(fn, 7)
+        self.assertEqual(results.shape, (2, 7))
+        self.assertTrue(numpy.array_equal(results[:, 0], [0, 1]))
+        self.assertFalse(results[:, 1:].any())
+
+    def testFirstCol(self):
+        lines = ['0 1 10.0 20.0 30.0 1.5 -2.5', '1 0']
+        for fn in [self._writeResults('first.txt', lines[:1]),
+                   self._writeResults('firstShort.txt', lines)]:
+            results = loadResultsFile(fn, 7, firstCol=1)
+            self.assertEqual(results.shape[1], 6)
+            self.assertTrue(numpy.allclose(results[0],
+                                           [1, 10.0, 20.0, 30.0, 1.5, -2.5]))
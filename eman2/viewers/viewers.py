@@ -191,8 +191,7 @@ Examples:
             v = self.createScipionView(fn)
             views.append(v)
         else:
-            for it in self._iterations:
-                fn = self.protocol._getIterClasses(it)
+            for fn in self.protocol._getIterClassesList(self._iterations):
                 v = self.createScipionView(fn)
                 views.append(v)
 